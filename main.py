@@ -15,12 +15,17 @@ zones, with proxying enabled or disabled. The tool runs checks and updates every
 
 import time
 import socket
+import ipaddress
 import logging
 import sys
 import os
-import json
+from itertools import islice
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import orjson
 import requests
-import schedule
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Replace with your actual data
 CF_API_TOKEN = os.getenv("CF_API_TOKEN")
@@ -28,6 +33,8 @@ CF_ZONE_ID = os.getenv("CF_ZONE_ID")
 DNS_RECORD_COMMENT_KEY = os.getenv('DNS_RECORD_COMMENT_KEY')
 DOMAINS_FILE_PATH = os.getenv('DOMAINS_FILE_PATH')
 SCHEDULE_MINUTES = int(os.getenv('SCHEDULE_MINUTES', '60'))
+CF_BATCH_SIZE = int(os.getenv('CF_BATCH_SIZE', '200'))
+CACHE_TTL_MINUTES = int(os.getenv('CACHE_TTL_MINUTES', '60'))
 
 # Define API endpoints
 BASE_URL = 'https://api.cloudflare.com/client/v4/'
@@ -44,6 +51,10 @@ def create_logger(level=logging.INFO):
     """ Create the logger object """
     logger = logging.getLogger("MGE-Logs")
 
+    # Handlers are attached to the named logger, so creating it twice would duplicate every line
+    if logger.handlers:
+        return logger
+
     # Create handlers
     console_handler = logging.StreamHandler(sys.stdout)
     file_handler = logging.FileHandler('dns_updater.log')
@@ -61,68 +72,152 @@ def create_logger(level=logging.INFO):
     logger.addHandler(file_handler)
     logger.addHandler(console_handler)
     logger.setLevel(level)
+    logger.propagate = False
 
     return logger
 
 
 LOGGER = create_logger()
 
+# The configuration cannot change without a restart, so validate it once at startup
+if CF_ZONE_ID is None:
+    LOGGER.error("CF_ZONE_ID: At least one zone id must be set.")
+    sys.exit(1)
+if CF_API_TOKEN is None:
+    LOGGER.error("CF_API_TOKEN Missing: You have to provide your Cloudflare API Token.")
+    sys.exit(1)
+if DNS_RECORD_COMMENT_KEY is None and DOMAINS_FILE_PATH is None:
+    LOGGER.error("DNS_RECORD_COMMENT_KEY and DOMAINS_FILE_PATH are missing, don't know which domains to update")
+    sys.exit(1)
+
+# Public IP the records were last synced to, lets unchanged runs skip the zone walk
+LAST_SYNC = {
+    'public_ip': None,
+    'domains_mtime_ns': None,
+    'synced_at': 0.0,
+}
+
+# DNS records of each zone keyed by zone id, stored as (fetched_at, records)
+ZONE_CACHE = {}
+
+# Shared session so consecutive Cloudflare calls reuse the same TLS connection
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    # The batch POST only sets record contents, so retrying it is idempotent
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'POST'},
+        raise_on_status=False
+    )
+))
+SESSION.headers.update({
+    'Authorization': f'Bearer {CF_API_TOKEN}',
+    'Content-Type': 'application/json',
+})
+
+# Each IP checking service gets its own keep-alive session, separate from the one carrying the Cloudflare token
+IP_SESSIONS = {service: requests.Session() for service in IP_CHECK_SERVICES}
+
+# Long-lived pool used to query the IP checking services in parallel
+IP_EXECUTOR = ThreadPoolExecutor(max_workers=len(IP_CHECK_SERVICES))
+
+
+def fetch_zone_records(zone_id):
+    """ Fetches every DNS record of a zone, following pagination """
+    records = []
+    page = 1
+    total_pages = 1
 
-def get_dns_record(zone_id, domain_name):
-    """ Get current DNS record for the specified domain """
-    LOGGER.info("Fetching record for '%s' in zone '%s'.", domain_name, zone_id)
+    while page <= total_pages:
+        params = {
+            'per_page': 5000,
+            'page': page,
+        }
 
-    headers = {
-        'Authorization': 'Bearer ' + CF_API_TOKEN,
-        'Content-Type': 'application/json',
-    }
+        LOGGER.info("Fetching page %s of records in zone '%s'.", page, zone_id)
 
-    params = {
-        'name': domain_name,
-    }
+        try:
+            response = SESSION.get(f'{BASE_URL}zones/{zone_id}/dns_records', params=params, timeout=60)
+        except requests.exceptions.RequestException as exc:
+            LOGGER.error("Failed to fetch records for zone '%s': %s", zone_id, exc)
+            return None
 
-    response = requests.get(f'{BASE_URL}zones/{zone_id}/dns_records', headers=headers, params=params, timeout=60)
+        if response.status_code != 200:
+            LOGGER.error("Failed to fetch records for zone '%s'. Response: %s", zone_id, response.text)
+            return None
 
-    if response.status_code == 200:
-        records = response.json()['result']
+        data = orjson.loads(response.content)
 
-        if records:
-            LOGGER.info("Successfully fetched data for '%s'.", domain_name)
-            return records[0]
-    else:
-        LOGGER.error("Failed to fetch data for '%s'. Response: %s", domain_name, response.json())
+        records.extend(data['result'])
+        total_pages = data['result_info']['total_pages']
+        page += 1
 
-    return None
+    for record in records:
+        record.setdefault('zone_id', zone_id)
+
+    return records
 
 
-def update_dns_record(record, content):
-    """ Update the DNS record """
-    headers = {
-        'Authorization': 'Bearer ' + CF_API_TOKEN,
-        'Content-Type': 'application/json',
-    }
+def list_zone_records(zone_ids, started_at):
+    """ Returns the DNS records of each zone, refreshing cache entries older than CACHE_TTL_MINUTES at started_at """
+    expired = [
+        zone_id for zone_id in zone_ids
+        if zone_id not in ZONE_CACHE or started_at - ZONE_CACHE[zone_id][0] >= CACHE_TTL_MINUTES * 60
+    ]
+
+    for zone_id in expired:
+        records = fetch_zone_records(zone_id)
+
+        if records is None:
+            # Never serve expired records, the zone's domains then resolve to None and the sync stays open
+            ZONE_CACHE.pop(zone_id, None)
+        else:
+            ZONE_CACHE[zone_id] = (started_at, records)
+
+    return {zone_id: ZONE_CACHE[zone_id][1] for zone_id in zone_ids if zone_id in ZONE_CACHE}
 
+
+def chunked(iterable, size):
+    """ Split an iterable into lists of at most `size` items """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def batch_update_dns_records(zone_id, patches):
+    """ Update multiple DNS records of a zone with a single batch request """
     data = {
-        'content': content
+        'patches': patches
     }
 
-    response = requests.patch(
-                f"{BASE_URL}zones/{record['zone_id']}/dns_records/{record['id']}",
-                json=data,
-                headers=headers,
-                timeout=30
-            )
+    try:
+        response = SESSION.post(
+                    f"{BASE_URL}zones/{zone_id}/dns_records/batch",
+                    data=orjson.dumps(data),
+                    timeout=30
+                )
+    except requests.exceptions.RequestException as exc:
+        LOGGER.error("Failed to update DNS records in zone '%s': %s", zone_id, exc)
+        return False
 
     if response.status_code == 200:
-        LOGGER.info("DNS record updated successfully: %s (%s) -> %s", record['name'], record['type'], content)
-    else:
-        LOGGER.error("Failed to update DNS record: %s", response.json())
+        for record in orjson.loads(response.content)['result']['patches']:
+            LOGGER.info("DNS record updated successfully: %s (%s) -> %s", record['name'], record['type'], record['content'])
+        return True
 
+    LOGGER.error("Failed to update DNS records in zone '%s': %s", zone_id, response.text)
+    return False
 
-def read_zones_from_file(json_file_path, zone_id):
-    """ Loads static wishlist of domains in json format along with their metadata """
-    with open(json_file_path, 'r', encoding="utf-8") as file:
-        data = json.load(file)
+
+@lru_cache(maxsize=4)
+def load_zones_file(json_file_path, _mtime_ns, zone_id):
+    """ Parses the domains file, the modification time only serves as part of the cache key """
+    with open(json_file_path, 'rb') as file:
+        data = orjson.loads(file.read())
 
     zones = data['zones']
 
@@ -138,89 +233,178 @@ def read_zones_from_file(json_file_path, zone_id):
     return zones
 
 
-def get_dns_records_by_name(zones):
-    """ Fetches all DNS records that were loaded from file """
-    records = []
+def read_zones_from_file(json_file_path, zone_id):
+    """ Loads static wishlist of domains in json format along with their metadata """
+    return load_zones_file(json_file_path, os.stat(json_file_path).st_mtime_ns, zone_id)
+
 
+def get_dns_records_by_name(zones, started_at):
+    """ Fetches all DNS records that were loaded from file, None marks a domain that could not be resolved """
     LOGGER.info("Trying to fetch records for %s zones.", len(zones))
 
+    zone_records = list_zone_records(list({domain['zone_id'] for zone in zones for domain in zone['domains']}), started_at)
+
+    # Index the A records of each zone by name once, keeping the first record listed for a name.
+    # DNS names are case-insensitive, Cloudflare matched them that way when filtering by name
+    records_by_name = {
+        zone_id: {record['name'].lower(): record for record in reversed(records) if record['type'] == 'A'}
+        for zone_id, records in zone_records.items()
+    }
+
+    records = []
+
     for zone in zones:
         for domain in zone['domains']:
-            record = get_dns_record(domain['zone_id'], domain['name'])
+            record = records_by_name.get(domain['zone_id'], {}).get(domain['name'].lower())
 
-            if record is not None:
-                records.append(record)
+            if record is None:
+                LOGGER.error("Failed to find A record for '%s' in zone '%s'.", domain['name'], domain['zone_id'])
+
+            records.append(record)
 
     return records
 
 
 def get_dns_records_by_comment(zone_id, comment_key):
-    """ Fetches all DNS records that contain the comment key inside of the comment """
-    headers = {
-        'Authorization': 'Bearer ' + CF_API_TOKEN,
-        'Content-Type': 'application/json',
-    }
-
+    """ Fetches all DNS records that contain the comment key inside of the comment, None if the request failed """
     params = {
         'comment.contains': comment_key,
     }
 
     LOGGER.info("Fetching DNS record with comment key: %s", comment_key)
-    response = requests.get(f'{BASE_URL}zones/{zone_id}/dns_records', headers=headers, params=params, timeout=60)
+    try:
+        response = SESSION.get(f'{BASE_URL}zones/{zone_id}/dns_records', params=params, timeout=60)
+    except requests.exceptions.RequestException as exc:
+        LOGGER.error("Failed to get dns_records with comment key: %s", exc)
+        return None
 
     if response.status_code == 200:
-        records = response.json()['result']
+        data = orjson.loads(response.content)
+        records = data['result']
         if records and len(records) > 0:
             return records
-        LOGGER.warning("Request was successful but no valid domains were found: %s", response.json())
+        LOGGER.warning("Request was successful but no valid domains were found: %s", data)
         return []
 
-    LOGGER.error("Failed to get dns_records with comment key: %s", response.json())
+    LOGGER.error("Failed to get dns_records with comment key: %s", response.text)
 
-    return []
+    return None
+
+
+def fetch_public_ip(service):
+    """ Get public IPv4 address from a single IP checking service """
+    try:
+        response = IP_SESSIONS[service].get(service, timeout=3)
+    except requests.exceptions.RequestException:
+        return None
+
+    if response.status_code != 200:
+        return None
+
+    public_ip = response.text.strip()
+
+    # A records only take IPv4, dual-stack hosts may get an IPv6 answer from some services
+    try:
+        if ipaddress.ip_address(public_ip).version == 4:
+            return public_ip
+    except ValueError:
+        pass
+    return None
 
 
 def get_public_ip():
-    """ Get public IP address from the list of IP checking services """
-    for service in IP_CHECK_SERVICES:
-        try:
-            response = requests.get(service, timeout=5)
-            if response.status_code == 200:
-                return response.text.strip()
-        except requests.exceptions.RequestException:
-            continue
+    """ Get public IP address from the fastest of the IP checking services """
+    futures = [IP_EXECUTOR.submit(fetch_public_ip, service) for service in IP_CHECK_SERVICES]
+
+    # The slower services finish in the background, their answers are not needed
+    for future in as_completed(futures):
+        public_ip = future.result()
+        if public_ip:
+            return public_ip
     return None
 
 
 def is_connected():
     """ Check if there is an active internet connection """
     try:
-        host = socket.gethostbyname("www.cloudflare.com")
-        socket.create_connection((host, 80), 2)
+        # Connecting a UDP socket sends no packets, it only checks that the host is routable
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(1)
+            sock.connect(("1.1.1.1", 53))
         return True
     except socket.error as exc:
         LOGGER.error("Socket error: %s", exc)
     return False
 
-def check_and_update_dns():
-    """ Function to run the check and update process """
+def update_dns_records(domain_records, public_ip):
+    """ Points every record at the public IP, returns False if any record could not be synced """
+    synced = True
+    records_by_zone = {}
+    unchanged_domains = []
+
+    for record in domain_records:
+        # Unresolved domains were already logged, leave the sync open so the next run retries them
+        if record is None:
+            synced = False
+            continue
+
+        domain_name = record['name']
+
+        # Batches are all-or-nothing, a single AAAA or TXT record would fail every A record of the zone
+        if record['type'] != 'A':
+            LOGGER.info("Skipping %s record %s, only A records are updated.", record['type'], domain_name)
+            continue
+
+        if public_ip != record['content']:
+            # Keyed by record id so a domain listed twice is only patched once per batch
+            records_by_zone.setdefault(record['zone_id'], {})[record['id']] = record
+        else:
+            unchanged_domains.append(domain_name)
+
+    if unchanged_domains and LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug("IP addresses are the same for %s domains. No update needed: [%s]", len(unchanged_domains), ','.join(unchanged_domains))
+
+    # Cloudflare caps the number of changes per batch request (200 on free plans)
+    for zone_id, records in records_by_zone.items():
+        for chunk in chunked(records.values(), CF_BATCH_SIZE):
+            patches = [{'id': record['id'], 'content': public_ip} for record in chunk]
+
+            if batch_update_dns_records(zone_id, patches):
+                # Keep the cached zone records in line with what was just written
+                for record in chunk:
+                    record['content'] = public_ip
+            else:
+                # Batches are all-or-nothing, a single stale record id fails the whole zone so re-list it next run
+                ZONE_CACHE.pop(zone_id, None)
+                synced = False
+
+    return synced
+
+
+def check_and_update_dns(started_at):
+    """ Function to run the check and update process, started_at is the monotonic time the run was scheduled at """
     LOGGER.info("Run triggered by schedule.")
 
     if not is_connected():
         LOGGER.error("No internet connection. Skipping check and update.")
         return
 
-    if CF_ZONE_ID is None:
-        LOGGER.error("CF_ZONE_ID: At least one zone id must be set.")
-        return
-    if CF_API_TOKEN is None:
-        LOGGER.error("CF_API_TOKEN Missing: You have to provide your Cloudflare API Token.")
+    public_ip = get_public_ip()
+
+    if not public_ip:
+        LOGGER.error("Failed to retrieve public IP. Skipping check and update.")
         return
-    if DNS_RECORD_COMMENT_KEY is None and DOMAINS_FILE_PATH is None:
-        LOGGER.error("DNS_RECORD_COMMENT_KEY and DOMAINS_FILE_PATH are missing, don't know which domains to update")
+
+    # A domains file edited since the last sync is applied right away instead of after the TTL
+    domains_mtime_ns = os.stat(DOMAINS_FILE_PATH).st_mtime_ns if DNS_RECORD_COMMENT_KEY is None else None
+
+    # Re-fetch the records once the cache expires to catch edits made outside of this tool
+    cache_age = started_at - LAST_SYNC['synced_at']
+    unchanged = public_ip == LAST_SYNC['public_ip'] and domains_mtime_ns == LAST_SYNC['domains_mtime_ns']
+    if unchanged and cache_age < CACHE_TTL_MINUTES * 60:
+        LOGGER.info("Public IP %s unchanged since last sync. Skipping check and update.", public_ip)
         return
 
-    public_ip = get_public_ip()
     domain_records = []
 
     if DNS_RECORD_COMMENT_KEY is not None:
@@ -228,36 +412,27 @@ def check_and_update_dns():
         domain_records = get_dns_records_by_comment(CF_ZONE_ID, DNS_RECORD_COMMENT_KEY)
     else:
         LOGGER.info("Using DOMAINS_FILE_PATH='%s' to find DNS records to update.", DOMAINS_FILE_PATH)
-        domain_records = get_dns_records_by_name(read_zones_from_file(DOMAINS_FILE_PATH, CF_ZONE_ID))
+        domain_records = get_dns_records_by_name(read_zones_from_file(DOMAINS_FILE_PATH, CF_ZONE_ID), started_at)
 
-    valid_domains = [x['name'] for x in domain_records if x is not None]
-    LOGGER.info("Found %s valid domains for update: [%s]", len(valid_domains), ','.join(valid_domains))
+    if domain_records is None:
+        LOGGER.error("Failed to fetch DNS records. Skipping check and update.")
+        return
 
-    if public_ip:
-        for record in domain_records:
-            domain_name = record['name']
+    if LOGGER.isEnabledFor(logging.INFO):
+        valid_domains = [x['name'] for x in domain_records if x is not None]
+        LOGGER.info("Found %s valid domains for update: [%s]", len(valid_domains), ','.join(valid_domains))
 
-            if record is None:
-                LOGGER.error("DNS record for %s not found.", domain_name)
-                continue
-
-            if public_ip != record['content']:
-                update_dns_record(
-                    record,
-                    public_ip
-                )
-            else:
-                LOGGER.info("IP addresses are the same for %s. No update needed.", domain_name)
-    else:
-        LOGGER.error("Failed to retrieve public IP. Skipping check and update.")
+    if update_dns_records(domain_records, public_ip):
+        LAST_SYNC['public_ip'] = public_ip
+        LAST_SYNC['domains_mtime_ns'] = domains_mtime_ns
+        # Stamped with the start of the run so the cache expires exactly SCHEDULE_MINUTES apart
+        LAST_SYNC['synced_at'] = started_at
 
 
 LOGGER.info("Schedule is set at %s minutes", SCHEDULE_MINUTES)
 
-# Schedule the check and update process to run every X minutes
-schedule.every(SCHEDULE_MINUTES).minutes.do(check_and_update_dns).run()
-
-# Main loop
+# Run the check and update process every X minutes, sleeping until the next run is due
 while True:
-    schedule.run_pending()
-    time.sleep(1)
+    run_started_at = time.monotonic()
+    check_and_update_dns(run_started_at)
+    time.sleep(max(0, run_started_at + SCHEDULE_MINUTES * 60 - time.monotonic()))